@@ -1,22 +1,67 @@
 import ast
 import argparse
+import atexit
+import json
+import os
+import re
+import stat
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import NamedTuple, Text, Tuple, List, Optional
+from typing import Dict, Text, Tuple, List, Optional
 
-import graphviz
+CACHE_PATH = Path.home() / ".cache" / "amgraph" / "parse.json"
 
+# Minimum number of files to parse before a process pool is worth its
+# spawn overhead.
+MIN_PARALLEL_FILES = 16
 
-class Revision(NamedTuple):
+# Alembic places the revision assignments at the top of each file, so
+# usually only this much of it needs to be read and parsed.
+HEADER_READ_SIZE = 2048
+
+REVISION_RE = re.compile(rb"^revision\s*=\s*(.+)$", re.MULTILINE)
+DOWN_REVISION_RE = re.compile(rb"^down_revision\s*=\s*(.+)$", re.MULTILINE)
+
+DOT_LABEL_ESCAPES = str.maketrans({"\\": r"\\", '"': r"\"", "\n": r"\n"})
+
+_parse_cache: Optional[Dict] = None
+_parse_cache_dirty = False
+
+
+class RevisionParseError(Exception):
+    pass
+
+
+@dataclass(slots=True)
+class Revision:
     identifier: Text
     down_revision: Tuple[Optional[Text], ...]
     filename: Path
-    labels: List[Text]
+    labels: List[Text] = field(default_factory=list)
+    key: Tuple[Text, ...] = ()
+    node_id: Text = ""
+
+    @staticmethod
+    def build(
+        identifier: Text,
+        down_revision: Tuple[Optional[Text], ...],
+        filename: Path,
+    ) -> "Revision":
+        key = (identifier,) + tuple(
+            sorted(entry for entry in down_revision if entry is not None)
+        )
+        return Revision(
+            identifier, down_revision, filename, key=key, node_id=str(hash(key))
+        )
 
     @staticmethod
     def from_ast_node(node: ast.AST, filename: Path):
         identifier = None
         down_revision = None
+        down_revision_found = False
 
         for subnode in ast.iter_child_nodes(node):
             if not isinstance(subnode, ast.Assign):
@@ -31,6 +76,10 @@ class Revision(NamedTuple):
                 identifier = ast.literal_eval(subnode.value)
             elif var_name == "down_revision":
                 down_revision = ast.literal_eval(subnode.value)
+                down_revision_found = True
+
+            if identifier is not None and down_revision_found:
+                break
 
         if not identifier:
             raise ValueError("Unable to find revision identifier.")
@@ -38,10 +87,37 @@ class Revision(NamedTuple):
         if not isinstance(down_revision, tuple):
             down_revision = (down_revision,)
 
-        return Revision(identifier, down_revision, filename, [])
+        return Revision.build(identifier, down_revision, filename)
+
+    @staticmethod
+    def from_source(source: bytes, filename: Path):
+        revision_match = REVISION_RE.search(source)
+        down_match = DOWN_REVISION_RE.search(source)
+
+        if revision_match and down_match:
+            try:
+                identifier = ast.literal_eval(
+                    revision_match.group(1).strip().decode("utf-8")
+                )
+                down_revision = ast.literal_eval(
+                    down_match.group(1).strip().decode("utf-8")
+                )
+            except (ValueError, SyntaxError):
+                # A right-hand side the regexes cannot handle (e.g. a
+                # tuple spanning multiple lines); parse the file instead.
+                pass
+            else:
+                if identifier:
+                    if not isinstance(down_revision, tuple):
+                        down_revision = (down_revision,)
+
+                    return Revision.build(identifier, down_revision, filename)
+
+        node = ast.parse(source, filename.name)
+        return Revision.from_ast_node(node, filename)
 
     def identity(self) -> Text:
-        return str(hash((self.identifier,) + tuple(sorted(self.down_revision))))
+        return self.node_id
 
     def is_initial(self) -> bool:
         return self.down_revision == (None,)
@@ -55,28 +131,166 @@ def print_err(*args, **kwargs) -> None:
     exit(1)
 
 
-def read_revisions(versions: Path) -> List[Revision]:
+def _load_parse_cache() -> Dict:
+    global _parse_cache
+
+    if _parse_cache is None:
+        try:
+            with CACHE_PATH.open() as f:
+                _parse_cache = json.load(f)
+        except (OSError, ValueError):
+            _parse_cache = {}
+
+    return _parse_cache
+
+
+def _save_parse_cache() -> None:
+    if not _parse_cache_dirty or _parse_cache is None:
+        return
+
+    try:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_PATH.parent)
+
+        with os.fdopen(fd, "w") as f:
+            json.dump(_parse_cache, f)
+
+        os.replace(tmp_path, CACHE_PATH)
+    except OSError:
+        pass
+
+
+atexit.register(_save_parse_cache)
+
+
+def _parse_one(element: Path) -> Revision:
+    # Read bytes through a raw file descriptor: the regexes work on
+    # bytes directly, ast.parse handles the PEP 263 encoding cookie
+    # itself, and skipping stdio buffering avoids an extra copy for
+    # files this small.
+    fd = os.open(element, os.O_RDONLY)
+
+    try:
+        source = os.read(fd, HEADER_READ_SIZE)
+        truncated = len(source) == HEADER_READ_SIZE
+
+        # A truncated read can end cleanly between the two assignments,
+        # yielding source that parses but is missing down_revision; only
+        # trust it when the down_revision assignment is present.
+        if not truncated or DOWN_REVISION_RE.search(source):
+            try:
+                return Revision.from_source(source, element)
+            except (SyntaxError, ValueError):
+                if not truncated:
+                    raise
+
+        # The header read cut the file mid-statement, or short of the
+        # revision assignments; read the rest and parse it whole.
+        chunks = [source]
+
+        while True:
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                break
+
+            chunks.append(chunk)
+
+        source = b"".join(chunks)
+    finally:
+        os.close(fd)
+
+    return Revision.from_source(source, element)
+
+
+def _parse_many(elements: List[Path]) -> List[Revision]:
     revisions = []
 
-    for element in versions.iterdir():
-        conditions = [
-            element.is_file(),
-            str(element).endswith(".py"),
-            element.name != "__init__.py",
-        ]
+    if len(elements) < MIN_PARALLEL_FILES:
+        for element in elements:
+            try:
+                revisions.append(_parse_one(element))
+            except (ValueError, AttributeError) as e:
+                raise RevisionParseError(
+                    f"Unable to read file {element.name}: {e}"
+                ) from e
 
-        if not all(conditions):
-            continue
+        return revisions
 
-        with element.open() as f:
-            node = ast.parse(f.read(), element.name)
+    with ProcessPoolExecutor() as executor:
+        futures = [executor.submit(_parse_one, element) for element in elements]
 
-        try:
-            revision = Revision.from_ast_node(node, element)
-        except (ValueError, AttributeError) as e:
-            print_err(f"Unable to read file {element.name}: {e}")
+        for element, future in zip(elements, futures):
+            error = future.exception()
+
+            if isinstance(error, (ValueError, AttributeError)):
+                raise RevisionParseError(
+                    f"Unable to read file {element.name}: {error}"
+                ) from error
+            elif error is not None:
+                raise error
+
+            revisions.append(future.result())
+
+    return revisions
+
+
+def _cached_revision(
+    cached, st: os.stat_result, element: Path
+) -> Optional[Revision]:
+    # The cache file is user-editable JSON; treat anything that is stale
+    # or not the expected shape as a miss, so it gets re-parsed and
+    # written back.
+    try:
+        if cached["mtime"] != st.st_mtime_ns or cached["size"] != st.st_size:
+            return None
+
+        return Revision.build(cached["id"], tuple(cached["down"]), element)
+    except (TypeError, KeyError):
+        return None
+
+
+def read_revisions(versions: Path) -> List[Revision]:
+    global _parse_cache_dirty
 
-        revisions.append(revision)
+    cache = _load_parse_cache()
+    revisions: List[Optional[Revision]] = []
+    pending: List[Tuple[int, Path, os.stat_result]] = []
+
+    with os.scandir(versions) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".py") or entry.name == "__init__.py":
+                continue
+
+            # A single stat per entry serves both the regular-file check
+            # and the cache validation.
+            st = entry.stat(follow_symlinks=False)
+
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            element = Path(entry.path)
+            revision = _cached_revision(cache.get(entry.path), st, element)
+
+            if revision is not None:
+                revisions.append(revision)
+                continue
+
+            pending.append((len(revisions), element, st))
+            revisions.append(None)
+
+    if pending:
+        parsed = _parse_many([element for _, element, _ in pending])
+
+        for (index, element, st), revision in zip(pending, parsed):
+            revisions[index] = revision
+            cache[str(element)] = {
+                "mtime": st.st_mtime_ns,
+                "size": st.st_size,
+                "id": revision.identifier,
+                "down": list(revision.down_revision),
+            }
+
+        _parse_cache_dirty = True
 
     return revisions
 
@@ -85,61 +299,116 @@ def flatten_groups(
     revision_groups: List[List[Revision]], dir_labels: List[Text]
 ) -> List[Revision]:
     result = {}
+    setdefault = result.setdefault
 
-    for i, revisions in enumerate(revision_groups):
+    # Deduplicate first, without any per-revision label branch; a second
+    # pass attaches labels only when they were requested.
+    for revisions in revision_groups:
         for revision in revisions:
-            final_rev = result.setdefault(revision.identity(), revision)
+            setdefault(revision.key, revision)
 
-            if dir_labels:
-                final_rev.labels.append(dir_labels[i])
+    if dir_labels:
+        for label, revisions in zip(dir_labels, revision_groups):
+            for revision in revisions:
+                result[revision.key].labels.append(label)
 
     return list(result.values())
 
 
-def create_graph(
-    name: Text,
-    revision_groups: List[Revision],
-    dir_labels: List[Text],
-    short_node_labels: bool,
-    reverse: bool,
-) -> graphviz.Digraph:
-    dot = graphviz.Digraph(name=name)
+def _flatten_plain(revision_groups: List[List[Revision]]) -> List[Revision]:
+    merged: Dict[Tuple[Text, ...], Revision] = {}
+
+    # Keep the first occurrence of each key, matching flatten_groups'
+    # setdefault semantics, so the displayed filename does not depend on
+    # whether --dir-labels was passed.
+    for revisions in revision_groups:
+        for revision in revisions:
+            if revision.key not in merged:
+                merged[revision.key] = revision
+
+    return list(merged.values())
 
-    if reverse:
-        # Ensure initial migration is placed at the bottom even when digraph is
-        # reversed.
-        dot.attr("graph", rankdir="BT")
 
-    revisions = flatten_groups(revision_groups, dir_labels)
+def _escape_label(label: Text) -> Text:
+    return label.translate(DOT_LABEL_ESCAPES)
 
+
+def _node_line(revision: Revision, label: Text) -> Text:
+    return '\t"{}" [label="{}" peripheries={} shape={}]\n'.format(
+        revision.identity(),
+        _escape_label(label),
+        "2" if revision.is_initial() else "1",
+        "box" if revision.is_merge() else "oval",
+    )
+
+
+def _emit_nodes_plain(
+    lines: List[Text], revisions: List[Revision], short_node_labels: bool
+) -> None:
     for revision in revisions:
-        dot.attr("node", peripheries="2" if revision.is_initial() else "1")
-        dot.attr(
-            "node", shape="box" if revision.is_merge() else "oval",
-        )
+        label = revision.identifier if short_node_labels else revision.filename.stem
+        lines.append(_node_line(revision, label))
 
+
+def _emit_nodes_labeled(
+    lines: List[Text], revisions: List[Revision], short_node_labels: bool
+) -> None:
+    for revision in revisions:
         label = revision.identifier if short_node_labels else revision.filename.stem
         if revision.labels:
             label += "\n" + ", ".join(revision.labels)
 
-        dot.node(revision.identity(), label=label)
+        lines.append(_node_line(revision, label))
 
-    for revision in revisions:
-        if revision.is_initial():
-            continue
 
-        for entry in revision.down_revision:
-            for candidate in revisions:
-                if candidate.identifier != entry:
-                    continue
+def create_graph(
+    name: Text,
+    revision_groups: List[Revision],
+    dir_labels: List[Text],
+    short_node_labels: bool,
+    reverse: bool,
+) -> "graphviz.Source":
+    # Imported lazily so that --help and argument-error paths do not pay
+    # graphviz's module import cost.
+    import graphviz
 
-                edge = [revision.identity(), candidate.identity()]
-                if reverse:
-                    edge.reverse()
+    # Build the DOT source directly instead of going through the Digraph
+    # object model; graphviz.Source exposes the same render() API.
+    lines = ['digraph "{}" {{\n'.format(_escape_label(name))]
 
-                dot.edge(*edge)
+    if reverse:
+        # Ensure initial migration is placed at the bottom even when digraph is
+        # reversed.
+        lines.append("\tgraph [rankdir=BT]\n")
+
+    if dir_labels:
+        revisions = flatten_groups(revision_groups, dir_labels)
+        _emit_nodes_labeled(lines, revisions, short_node_labels)
+    else:
+        # No directory labels: deduplicate with a plain dict and skip the
+        # per-revision label bookkeeping entirely.
+        revisions = _flatten_plain(revision_groups)
+        _emit_nodes_plain(lines, revisions, short_node_labels)
+
+    by_id = {revision.identifier: revision for revision in revisions}
+
+    edges = [
+        (revision.identity(), by_id[entry].identity())
+        for revision in revisions
+        if not revision.is_initial()
+        for entry in revision.down_revision
+        if entry in by_id
+    ]
 
-    return dot
+    if reverse:
+        edges = [(dst, src) for src, dst in edges]
+
+    for src, dst in edges:
+        lines.append('\t"{}" -> "{}"\n'.format(src, dst))
+
+    lines.append("}\n")
+
+    return graphviz.Source("".join(lines), filename=name)
 
 
 def read_args() -> argparse.Namespace:
@@ -175,7 +444,10 @@ def main() -> None:
         if not version_dir.is_dir():
             print_err(f"Error: '{args.versions}' is not a directory.")
 
-        revision_groups.append(read_revisions(version_dir))
+        try:
+            revision_groups.append(read_revisions(version_dir))
+        except RevisionParseError as e:
+            print_err(str(e))
 
     dot = create_graph(
         args.output.stem,